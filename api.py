@@ -1,31 +1,58 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Tuple
+from concurrent.futures import ProcessPoolExecutor
+import orjson
+import asyncio
+import os
+import signal
 import uvicorn
 import traceback
 import logging
-from petr_cluster_service import get_clustering_results as petr_get_clustering_results
 from petr_cluster_service import get_cluster_summary as petr_get_cluster_summary
+from petr_cluster_service import get_batch_clustering_results as petr_get_batch_clustering_results
+from petr_cluster_service import get_cluster_report as petr_get_cluster_report
 from kirill_cluster_service import get_clustering_results as kirill_get_clustering_results
 from kirill_cluster_service import get_cluster_summary as kirill_get_cluster_summary
+from kirill_cluster_service import get_cluster_report as kirill_get_cluster_report
+from kirill_cluster_service import fit_vectorizer as kirill_fit_vectorizer
+from kirill_cluster_service import set_vectorizer as kirill_set_vectorizer
+from kirill_cluster_service import remember_texts as kirill_remember_texts
+from kirill_cluster_service import get_reservoir as kirill_get_reservoir
+from kirill_cluster_service import save_vectorizer as kirill_save_vectorizer
+from kirill_cluster_service import load_vectorizer as kirill_load_vectorizer
+from text_features import set_n_jobs
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# CPUs this process may run on, which can be fewer than the host has (e.g. in a container)
+CPU_COUNT = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+# Number of uvicorn worker processes; the CPUs are split between their clustering pools
+API_WORKERS = int(os.environ.get("WEB_CONCURRENCY", 2))
+# Clustering processes per uvicorn worker, and the CPUs each of them may use for parallel work
+POOL_WORKERS = max(1, CPU_COUNT // API_WORKERS)
+POOL_WORKER_JOBS = max(1, CPU_COUNT // (API_WORKERS * POOL_WORKERS))
+
+# Where Kirill's fitted vectorizer is kept between restarts
+KIRILL_VECTORIZER_PATH = os.environ.get("KIRILL_VECTORIZER_PATH", "kirill_vectorizer.joblib")
+
+# Concurrent Petr clustering requests are sent to the pool in batches of up to
+# PETR_MAX_BATCH_SIZE payloads, waiting at most PETR_MAX_BATCH_DELAY seconds
+PETR_MAX_BATCH_SIZE = 8
+PETR_MAX_BATCH_DELAY = 0.1
+# Maximum number of Petr clustering requests waiting for a batch
+PETR_MAX_PENDING = 16
+
 app = FastAPI(
     title="Package Error Clustering API",
     description="API for clustering package errors using two different approaches",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse
 )
 
-class PackageData(BaseModel):
-    data: List[Dict[str, Any]]
-
-class KirillPackageData(BaseModel):
-    data: List[Dict[str, Any]]
-    n_clusters: int = 10
-
 class LanguageStats(BaseModel):
     count: int
     clusters: int
@@ -35,17 +62,183 @@ class PetrClusterSummary(BaseModel):
     clusters: Dict[str, List[Dict[str, Any]]]
     language_stats: Dict[str, LanguageStats]
 
+async def read_request_body(request: Request) -> Dict[str, Any]:
+    """
+    Parse a request body with orjson and check its shape. The packages themselves are
+    passed to the services as they are, without validating every item.
+    """
+    try:
+        body = orjson.loads(await request.body())
+    except orjson.JSONDecodeError as e:
+        raise HTTPException(status_code=422, detail=f"Invalid JSON body: {str(e)}")
+    if not isinstance(body, dict) or not isinstance(body.get("data"), list):
+        raise HTTPException(status_code=422, detail="Request body must be an object with a 'data' list")
+    if not all(isinstance(item, dict) for item in body["data"]):
+        raise HTTPException(status_code=422, detail="Every item of 'data' must be an object")
+    return body
+
+async def read_package_data(request: Request) -> List[Dict[str, Any]]:
+    return (await read_request_body(request))["data"]
+
+async def read_kirill_package_data(request: Request) -> Tuple[List[Dict[str, Any]], int]:
+    body = await read_request_body(request)
+    n_clusters = body.get("n_clusters", 10)
+    if not isinstance(n_clusters, int) or isinstance(n_clusters, bool) or n_clusters < 1:
+        raise HTTPException(status_code=422, detail="'n_clusters' must be a positive integer")
+    return body["data"], n_clusters
+
+def init_pool_worker(vectorizer: Optional[Any] = None, n_jobs: int = 1):
+    """
+    Seed a clustering worker with Kirill's fitted vectorizer and limit its parallel work to
+    its share of the CPUs. Workers ignore termination signals sent to the whole process group
+    and are stopped by the pool on shutdown instead.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    kirill_set_vectorizer(vectorizer)
+    set_n_jobs(n_jobs)
+
+def create_worker_pool(vectorizer: Optional[Any] = None) -> ProcessPoolExecutor:
+    """
+    Create the process pool that runs the clustering, optionally seeding
+    every worker with a fitted vectorizer for Kirill's approach.
+    """
+    return ProcessPoolExecutor(
+        max_workers=POOL_WORKERS,
+        initializer=init_pool_worker,
+        initargs=(vectorizer, POOL_WORKER_JOBS)
+    )
+
+async def run_in_pool(func, *args):
+    """
+    Run a blocking clustering function in the worker pool without blocking the event loop.
+    """
+    return await asyncio.get_running_loop().run_in_executor(app.state.pool, func, *args)
+
+def replace_worker_pool(vectorizer: Any):
+    """
+    Make a fitted vectorizer the shared one and restart the pool so that every worker uses it.
+    Work already submitted to the old pool still completes.
+    """
+    app.state.kirill_vectorizer = vectorizer
+    old_pool, app.state.pool = app.state.pool, create_worker_pool(vectorizer)
+    old_pool.shutdown(wait=False)
+
+def saved_vectorizer_mtime() -> Optional[int]:
+    try:
+        return os.stat(KIRILL_VECTORIZER_PATH).st_mtime_ns
+    except OSError:
+        return None
+
+def save_kirill_vectorizer(vectorizer: Any):
+    app.state.kirill_vectorizer_mtime = kirill_save_vectorizer(vectorizer, KIRILL_VECTORIZER_PATH)
+    logger.info(f"Saved Kirill's vectorizer to {KIRILL_VECTORIZER_PATH}")
+
+def load_kirill_vectorizer():
+    """
+    Load the saved vectorizer if the file changed since this process last loaded or saved it,
+    e.g. because another API worker fitted or refitted it.
+    """
+    mtime = saved_vectorizer_mtime()
+    if mtime is None or mtime == app.state.kirill_vectorizer_mtime:
+        return
+    app.state.kirill_vectorizer_mtime = mtime
+    vectorizer = kirill_load_vectorizer(KIRILL_VECTORIZER_PATH)
+    if vectorizer is not None:
+        logger.info(f"Loaded Kirill's vectorizer from {KIRILL_VECTORIZER_PATH}")
+        replace_worker_pool(vectorizer)
+
+async def ensure_kirill_vectorizer(data: List[Dict[str, Any]]):
+    """
+    Sample the payload's error texts for refits and make sure the workers use the saved fitted
+    vectorizer, so that a payload gets the same features whichever worker clusters it.
+    Without a saved vectorizer it is fitted once, on the first payload.
+    """
+    texts = [item['errors'] for item in data]
+    kirill_remember_texts(texts)
+    async with app.state.kirill_fit_lock:
+        load_kirill_vectorizer()
+        if app.state.kirill_vectorizer is not None or not texts:
+            return
+        vectorizer = await run_in_pool(kirill_fit_vectorizer, texts)
+        save_kirill_vectorizer(vectorizer)
+        replace_worker_pool(vectorizer)
+
+async def petr_batch_loop(queue: asyncio.Queue):
+    """
+    Collect queued Petr clustering requests into batches and send each batch to the pool in one call.
+    The payloads of a batch are still clustered separately.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await queue.get()]
+        deadline = loop.time() + PETR_MAX_BATCH_DELAY
+        while len(batch) < PETR_MAX_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        try:
+            results = await run_in_pool(petr_get_batch_clustering_results, [data for data, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            continue
+
+        logger.info(f"Clustered a batch of {len(batch)} Petr requests")
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            # Only the request whose payload failed to load gets the error
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+@app.on_event("startup")
+async def start_worker_pool():
+    app.state.kirill_vectorizer = None
+    app.state.kirill_vectorizer_mtime = None
+    app.state.kirill_fit_lock = asyncio.Lock()
+    app.state.pool = create_worker_pool()
+    load_kirill_vectorizer()
+
+@app.on_event("shutdown")
+async def stop_worker_pool():
+    # Kirill's vectorizer is saved whenever it is fitted, so only the pool is stopped here
+    app.state.pool.shutdown()
+
+@app.on_event("startup")
+async def start_petr_batcher():
+    app.state.petr_queue = asyncio.Queue()
+    app.state.petr_pending = asyncio.Semaphore(PETR_MAX_PENDING)
+    app.state.petr_batcher = asyncio.create_task(petr_batch_loop(app.state.petr_queue))
+
+@app.on_event("shutdown")
+async def stop_petr_batcher():
+    app.state.petr_batcher.cancel()
+
 # Petr's clustering endpoints
-@app.post("/petr/cluster", response_model=List[Dict[str, Any]], tags=["Petr's Clustering"])
-async def petr_cluster_packages(package_data: PackageData):
+@app.post("/petr/cluster", response_model=None, tags=["Petr's Clustering"])
+async def petr_cluster_packages(request: Request):
     """
     Cluster packages using Petr's approach: K-means clustering grouped by programming language.
     The number of clusters per language is calculated using a logarithmic scale based on the number of samples.
     Expects input data with programming_language, error_type, and description fields.
+    Concurrent requests are sent to the worker pool together in batches.
     """
+    data = await read_package_data(request)
     try:
         logger.info("Processing Petr's clustering request")
-        result = petr_get_clustering_results(package_data.data)
+        async with app.state.petr_pending:
+            future = asyncio.get_running_loop().create_future()
+            await app.state.petr_queue.put((data, future))
+            result = await future
         logger.info(f"Successfully processed {len(result)} packages")
         return result
     except Exception as e:
@@ -53,15 +246,17 @@ async def petr_cluster_packages(package_data: PackageData):
         logger.error(traceback.format_exc())
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/petr/cluster/summary", response_model=PetrClusterSummary, tags=["Petr's Clustering"])
-async def petr_get_clusters_summary(package_data: PackageData):
+@app.post("/petr/cluster/summary", response_model=None, responses={200: {"model": PetrClusterSummary}},
+          tags=["Petr's Clustering"])
+async def petr_get_clusters_summary(request: Request):
     """
     Get a detailed summary of all clusters using Petr's approach.
     Includes statistics about the number of clusters per programming language.
     """
+    data = await read_package_data(request)
     try:
         logger.info("Processing Petr's clustering summary request")
-        result = petr_get_cluster_summary(package_data.data)
+        result = await run_in_pool(petr_get_cluster_summary, data)
         logger.info(f"Successfully generated summary with {result['total_clusters']} clusters")
         return result
     except Exception as e:
@@ -69,16 +264,35 @@ async def petr_get_clusters_summary(package_data: PackageData):
         logger.error(traceback.format_exc())
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/petr/cluster/report", response_model=None, tags=["Petr's Clustering"])
+async def petr_get_clusters_report(request: Request):
+    """
+    Get both the per-package clustering results and the cluster summary using Petr's approach,
+    computed from a single clustering run.
+    """
+    data = await read_package_data(request)
+    try:
+        logger.info("Processing Petr's clustering report request")
+        result = await run_in_pool(petr_get_cluster_report, data)
+        logger.info(f"Successfully generated report with {result['summary']['total_clusters']} clusters")
+        return result
+    except Exception as e:
+        logger.error(f"Error in Petr's clustering report: {str(e)}")
+        logger.error(traceback.format_exc())
+        raise HTTPException(status_code=500, detail=str(e))
+
 # Kirill's clustering endpoints
-@app.post("/kirill/cluster", response_model=List[Dict[str, Any]], tags=["Kirill's Clustering"])
-async def kirill_cluster_packages(package_data: KirillPackageData):
+@app.post("/kirill/cluster", response_model=None, tags=["Kirill's Clustering"])
+async def kirill_cluster_packages(request: Request):
     """
     Cluster packages using Kirill's approach: K-means clustering on error text.
     Expects input data with package name and errors fields.
     """
+    data, n_clusters = await read_kirill_package_data(request)
     try:
         logger.info("Processing Kirill's clustering request")
-        result = kirill_get_clustering_results(package_data.data, package_data.n_clusters)
+        await ensure_kirill_vectorizer(data)
+        result = await run_in_pool(kirill_get_clustering_results, data, n_clusters)
         logger.info(f"Successfully processed {len(result)} packages")
         return result
     except Exception as e:
@@ -86,14 +300,16 @@ async def kirill_cluster_packages(package_data: KirillPackageData):
         logger.error(traceback.format_exc())
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/kirill/cluster/summary", response_model=Dict[str, Any], tags=["Kirill's Clustering"])
-async def kirill_get_clusters_summary(package_data: KirillPackageData):
+@app.post("/kirill/cluster/summary", response_model=None, tags=["Kirill's Clustering"])
+async def kirill_get_clusters_summary(request: Request):
     """
     Get a detailed summary of all clusters using Kirill's approach.
     """
+    data, n_clusters = await read_kirill_package_data(request)
     try:
         logger.info("Processing Kirill's clustering summary request")
-        result = kirill_get_cluster_summary(package_data.data, package_data.n_clusters)
+        await ensure_kirill_vectorizer(data)
+        result = await run_in_pool(kirill_get_cluster_summary, data, n_clusters)
         logger.info(f"Successfully generated summary with {result['total_clusters']} clusters")
         return result
     except Exception as e:
@@ -101,6 +317,49 @@ async def kirill_get_clusters_summary(package_data: KirillPackageData):
         logger.error(traceback.format_exc())
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/kirill/cluster/report", response_model=None, tags=["Kirill's Clustering"])
+async def kirill_get_clusters_report(request: Request):
+    """
+    Get both the per-package clustering results and the cluster summary using Kirill's approach,
+    computed from a single clustering run.
+    """
+    data, n_clusters = await read_kirill_package_data(request)
+    try:
+        logger.info("Processing Kirill's clustering report request")
+        await ensure_kirill_vectorizer(data)
+        result = await run_in_pool(kirill_get_cluster_report, data, n_clusters)
+        logger.info(f"Successfully generated report with {result['summary']['total_clusters']} clusters")
+        return result
+    except Exception as e:
+        logger.error(f"Error in Kirill's clustering report: {str(e)}")
+        logger.error(traceback.format_exc())
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/admin/refit", response_model=None, tags=["Admin"])
+async def refit_vectorizer():
+    """
+    Refit the IDF weights of Kirill's shared TF-IDF vectorizer on a sample of recent inputs.
+    The sample is collected by this API process, the weights are refitted in one worker and
+    the pool is restarted so that every worker uses them. Other API processes load the saved
+    weights on their next Kirill request.
+    """
+    try:
+        logger.info("Refitting Kirill's vectorizer")
+        texts = kirill_get_reservoir()
+        if not texts:
+            return {"refitted": False, "n_features": 0}
+        async with app.state.kirill_fit_lock:
+            vectorizer = await run_in_pool(kirill_fit_vectorizer, texts)
+            save_kirill_vectorizer(vectorizer)
+            replace_worker_pool(vectorizer)
+        n_features = len(vectorizer.named_steps['tfidf'].idf_)
+        logger.info(f"Refitted vectorizer with {n_features} features")
+        return {"refitted": True, "n_features": n_features}
+    except Exception as e:
+        logger.error(f"Error refitting vectorizer: {str(e)}")
+        logger.error(traceback.format_exc())
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.get("/health")
 async def health_check():
     """
@@ -109,4 +368,4 @@ async def health_check():
     return {"status": "healthy"}
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8002) 
\ No newline at end of file
+    uvicorn.run("api:app", host="0.0.0.0", port=8002, workers=API_WORKERS) 
\ No newline at end of file
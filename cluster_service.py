@@ -1,7 +1,9 @@
 from typing import List, Dict, Any
 import json
 from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.cluster import DBSCAN
+from sklearn.neighbors import NearestNeighbors
+from scipy.sparse.csgraph import connected_components
+import scipy.sparse as sp
 import numpy as np
 from dataclasses import dataclass
 from collections import defaultdict
@@ -43,12 +45,25 @@ def cluster_packages(packages: List[Package]) -> List[Package]:
         texts = [f"{p.error_type} {p.description}" for p in lang_packages]
         
         # Convert text to TF-IDF vectors
-        vectorizer = TfidfVectorizer(max_features=1000, stop_words='english')
+        vectorizer = TfidfVectorizer(max_features=1000, stop_words='english', dtype=np.float32)
         features = vectorizer.fit_transform(texts)
         
-        # Apply DBSCAN clustering
-        clustering = DBSCAN(eps=0.7, min_samples=1)
-        cluster_labels = clustering.fit_predict(features.toarray())
+        # DBSCAN with min_samples=1 labels the connected components of the eps-neighbourhood
+        # graph. Rows are L2-normalised, so a cosine radius of 0.245 matches the former
+        # euclidean eps of 0.7.
+        neighbors = NearestNeighbors(radius=0.7 ** 2 / 2, metric='cosine', algorithm='brute').fit(features)
+        graph = neighbors.radius_neighbors_graph(mode='connectivity')
+        
+        # Rows without terms (e.g. only stop words) are all at euclidean distance 0 from each
+        # other but have no cosine distance, so they are linked into one component explicitly
+        empty_rows = np.flatnonzero(features.getnnz(axis=1) == 0)
+        if len(empty_rows) > 1:
+            links = sp.csr_matrix(
+                (np.ones(len(empty_rows) - 1), (np.full(len(empty_rows) - 1, empty_rows[0]), empty_rows[1:])),
+                shape=graph.shape
+            )
+            graph = graph + links
+        _, cluster_labels = connected_components(graph, directed=False)
         
         # Assign cluster IDs
         for package, label in zip(lang_packages, cluster_labels):
@@ -1,82 +1,274 @@
-from typing import List, Dict, Any
-from sklearn.feature_extraction.text import TfidfVectorizer
+from typing import List, Dict, Any, Optional, Tuple
+from sklearn.feature_extraction.text import HashingVectorizer, TfidfTransformer
+from sklearn.pipeline import Pipeline
+from sklearn.base import clone
 from sklearn.cluster import KMeans
 import numpy as np
-from dataclasses import dataclass
-from collections import defaultdict
-
-@dataclass
-class KirillPackage:
-    name: str
-    errors: str
-    cluster_id: int = -1
-
-def load_packages(json_data: List[Dict[str, Any]]) -> List[KirillPackage]:
-    packages = []
-    for item in json_data:
-        packages.append(KirillPackage(
-            name=item['package'],
-            errors=item['errors']
-        ))
-    return packages
-
-def cluster_packages(packages: List[KirillPackage], n_clusters: int = 10) -> List[KirillPackage]:
-    if not packages:
-        return []
-        
-    # Create feature vectors from error descriptions
-    texts = [p.errors for p in packages]
-    
-    # Convert text to TF-IDF vectors
-    vectorizer = TfidfVectorizer(
-        max_features=1000,
+from collections import OrderedDict
+import hashlib
+import logging
+import os
+import random
+import tempfile
+import threading
+import joblib
+from cachetools import TTLCache
+from text_features import hash_texts, payload_key, group_by_cluster, CentroidsCache
+
+logger = logging.getLogger(__name__)
+
+# Number of recent error texts kept for refitting the IDF weights
+RESERVOIR_SIZE = 10000
+# Number of transformed payloads kept in memory
+FEATURES_CACHE_SIZE = 32
+# Share of unknown tokens above which a payload gets its own vectorizer
+UNKNOWN_TOKEN_THRESHOLD = 0.2
+# Size of the table of tokens seen by the IDF fit; far larger than the feature space,
+# so that unseen tokens rarely collide with seen ones
+TOKEN_TABLE_SIZE = 2 ** 20
+# Number of centroid sets kept for warm-starting K-means
+CENTROIDS_CACHE_SIZE = 32
+# Iteration limit of K-means runs that start from cached centroids
+WARM_START_MAX_ITER = 20
+
+# Vectorizer shared between requests, fitted once and reused for transform
+_vectorizer: Optional[Pipeline] = None
+_idf_hash: Optional[str] = None
+_vectorizer_lock = threading.Lock()
+
+# Uniform sample of the texts seen so far (reservoir sampling)
+_reservoir: List[str] = []
+_reservoir_seen = 0
+_rng = random.Random(42)
+
+# LRU of TF-IDF matrices and whether they use the shared IDF, keyed by (IDF hash, payload hash)
+_features_cache: "OrderedDict[tuple, Any]" = OrderedDict()
+
+# Cluster labels of recently clustered payloads, keyed by (payload hash, n_clusters, IDF hash)
+_labels_cache = TTLCache(maxsize=64, ttl=60)
+_labels_cache_lock = threading.Lock()
+
+# LRU of converged K-means centroids keyed by (n_clusters, IDF hash)
+_centroids_cache = CentroidsCache(CENTROIDS_CACHE_SIZE)
+
+def build_vectorizer() -> Pipeline:
+    """Build an unfitted vectorizer: stateless feature hashing followed by TF-IDF weighting."""
+    hasher = HashingVectorizer(
+        n_features=2 ** 14,
+        alternate_sign=False,
+        norm=None,
+        ngram_range=(1, 2),
         stop_words='english',
         strip_accents='unicode',
-        token_pattern=r'\b\w+\b'
+        # Same tokens as r'\b\w+\b': a greedy \w+ match always ends on word boundaries.
+        # \w+ never backtracks in CPython's re; google-re2's findall was ~25x slower on
+        # kirill.json because of its per-match overhead, so the stdlib engine is kept.
+        token_pattern=r'\w+',
+        dtype=np.float32
     )
-    features = vectorizer.fit_transform(texts)
-    
-    # Apply K-means clustering
-    kmeans = KMeans(n_clusters=min(n_clusters, len(packages)), random_state=42)
-    cluster_labels = kmeans.fit_predict(features)
+    return Pipeline([('hasher', hasher), ('tfidf', TfidfTransformer())])
+
+def build_token_hasher(hasher: HashingVectorizer) -> HashingVectorizer:
+    """Unigram hasher with the tokenization of the feature hasher, used to detect unseen tokens."""
+    return clone(hasher).set_params(n_features=TOKEN_TABLE_SIZE, ngram_range=(1, 1))
+
+def fit_vectorizer(texts: List[str]) -> Pipeline:
+    if not texts:
+        raise ValueError("Cannot fit the vectorizer without any texts")
+    vectorizer = build_vectorizer()
+    hasher = vectorizer.named_steps['hasher']
+    vectorizer.named_steps['tfidf'].fit(hash_texts(hasher, texts))
+    # Remember which tokens the IDF weights were fitted on
+    vectorizer.seen_tokens_ = np.zeros(TOKEN_TABLE_SIZE, dtype=bool)
+    vectorizer.seen_tokens_[hash_texts(build_token_hasher(hasher), texts).indices] = True
+    return vectorizer
+
+def _hash_idf(vectorizer: Pipeline) -> str:
+    return hashlib.sha1(vectorizer.named_steps['tfidf'].idf_.tobytes()).hexdigest()
+
+def remember_texts(texts: List[str]) -> None:
+    """Add texts to the uniform sample the IDF weights are refitted on."""
+    global _reservoir_seen
+    with _vectorizer_lock:
+        for text in texts:
+            _reservoir_seen += 1
+            if len(_reservoir) < RESERVOIR_SIZE:
+                _reservoir.append(text)
+            else:
+                slot = _rng.randrange(_reservoir_seen)
+                if slot < RESERVOIR_SIZE:
+                    _reservoir[slot] = text
+
+def get_reservoir() -> List[str]:
+    """Return a copy of the sampled texts."""
+    with _vectorizer_lock:
+        return list(_reservoir)
+
+def _set_vectorizer(vectorizer: Pipeline) -> None:
+    global _vectorizer, _idf_hash
+    _vectorizer = vectorizer
+    _idf_hash = _hash_idf(vectorizer)
+    _features_cache.clear()
+
+def get_vectorizer(texts: List[str]) -> Pipeline:
+    """Return the shared vectorizer, fitting it on the given texts if it is not fitted yet."""
+    with _vectorizer_lock:
+        if _vectorizer is None:
+            _set_vectorizer(fit_vectorizer(texts))
+        return _vectorizer
+
+def set_vectorizer(vectorizer: Optional[Pipeline]) -> None:
+    """Install a fitted vectorizer as the shared one. None keeps the current state."""
+    if vectorizer is None:
+        return
+    with _vectorizer_lock:
+        _set_vectorizer(vectorizer)
+
+def save_vectorizer(vectorizer: Pipeline, path: str) -> int:
+    """
+    Write the vectorizer to a temporary file and move it into place, so readers never see a partial file.
+    Returns the modification time of the saved file in nanoseconds.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            joblib.dump(vectorizer, f)
+        # The rename keeps the modification time of the temporary file
+        mtime = os.stat(tmp_path).st_mtime_ns
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return mtime
+
+def load_vectorizer(path: str) -> Optional[Pipeline]:
+    """Load a saved vectorizer. A missing or unreadable file leaves the vectorizer unfitted."""
+    if not os.path.exists(path):
+        return None
+    try:
+        return joblib.load(path)
+    except Exception as e:
+        logger.error(f"Error loading vectorizer from {path}: {str(e)}")
+        return None
+
+def unknown_token_ratio(vectorizer: Pipeline, texts: List[str]) -> float:
+    """Share of token occurrences in the texts that were never seen when the IDF was fitted."""
+    seen = getattr(vectorizer, 'seen_tokens_', None)
+    if seen is None:
+        # Vectorizers saved before seen tokens were recorded never fall back
+        return 0.0
+    counts = hash_texts(build_token_hasher(vectorizer.named_steps['hasher']), texts)
+    total = counts.data.sum()
+    return counts.data[~seen[counts.indices]].sum() / total if total else 0.0
+
+def vectorize(texts: List[str]) -> Tuple[Any, bool]:
+    """Return the TF-IDF matrix of the texts and whether it uses the shared IDF weights."""
+    vectorizer = get_vectorizer(texts)
+    key = (_idf_hash, payload_key(texts))
+    with _vectorizer_lock:
+        cached = _features_cache.get(key)
+        if cached is not None:
+            _features_cache.move_to_end(key)
+            return cached
+
+    # Payloads that drifted away from the shared IDF weights get their own fit
+    counts = hash_texts(vectorizer.named_steps['hasher'], texts)
+    shared_idf = unknown_token_ratio(vectorizer, texts) <= UNKNOWN_TOKEN_THRESHOLD
+    if shared_idf:
+        features = vectorizer.named_steps['tfidf'].transform(counts)
+    else:
+        features = TfidfTransformer().fit_transform(counts)
+
+    with _vectorizer_lock:
+        _features_cache[key] = (features, shared_idf)
+        if len(_features_cache) > FEATURES_CACHE_SIZE:
+            _features_cache.popitem(last=False)
+    return features, shared_idf
+
+def predict_clusters(texts: List[str], n_clusters: int = 10,
+                     vectorizer: Optional[Pipeline] = None) -> np.ndarray:
+    """Return the cluster ID of every error text as one array."""
+    if not texts:
+        return np.empty(0, dtype=np.int64)
     
-    # Assign cluster IDs
-    for package, label in zip(packages, cluster_labels):
-        package.cluster_id = label
+    # Convert text to TF-IDF vectors using a pre-fitted or the shared vectorizer
+    if vectorizer is not None:
+        features, shared_idf = vectorizer.transform(texts), True
+    else:
+        features, shared_idf = vectorize(texts)
     
-    return packages
+    # Apply K-means clustering, starting from the centroids of the previous run if there is one.
+    # Payloads weighted with their own IDF fit neither use nor store the shared centroids.
+    n_clusters = min(n_clusters, len(texts))
+    key, init_centers = None, None
+    if shared_idf:
+        key = (n_clusters, _hash_idf(vectorizer) if vectorizer is not None else _idf_hash)
+        init_centers = _centroids_cache.get(key, (n_clusters, features.shape[1]))
+    if init_centers is not None:
+        kmeans = KMeans(n_clusters=n_clusters, init=init_centers, n_init=1,
+                        max_iter=WARM_START_MAX_ITER, random_state=42)
+    else:
+        kmeans = KMeans(n_clusters=n_clusters, random_state=42)
+    cluster_labels = kmeans.fit_predict(features)
+    if key is not None:
+        _centroids_cache.store(key, kmeans.cluster_centers_)
+    return cluster_labels
 
-def get_clustering_results(json_data: List[Dict[str, Any]], n_clusters: int = 10) -> List[Dict[str, Any]]:
-    packages = load_packages(json_data)
-    clustered_packages = cluster_packages(packages, n_clusters)
+def cluster_payload(json_data: List[Dict[str, Any]], n_clusters: int = 10) -> np.ndarray:
+    """Cluster the error texts of a payload, reusing the labels of a payload clustered shortly before."""
+    if not json_data:
+        return np.empty(0, dtype=np.int64)
     
-    # Convert to native Python types
-    results = []
-    for package in clustered_packages:
-        results.append({
-            'package': package.name,
-            'errors': package.errors,
-            'cluster_id': int(package.cluster_id)  # Convert numpy.int32 to Python int
-        })
-    return results
+    # The list only references the strings of the payload, it does not copy them
+    texts = [item['errors'] for item in json_data]
+    # Fit the vectorizer before building the key, so that the key carries its IDF hash
+    get_vectorizer(texts)
+    key = (payload_key(json_data), n_clusters, _idf_hash)
+    with _labels_cache_lock:
+        cluster_labels = _labels_cache.get(key)
+    if cluster_labels is None:
+        cluster_labels = predict_clusters(texts, n_clusters)
+        with _labels_cache_lock:
+            _labels_cache[key] = cluster_labels
+    return cluster_labels
 
-def get_cluster_summary(json_data: List[Dict[str, Any]], n_clusters: int = 10) -> Dict[str, Any]:
-    packages = load_packages(json_data)
-    clustered_packages = cluster_packages(packages, n_clusters)
-    
-    clusters = defaultdict(list)
-    for package in clustered_packages:
-        clusters[int(package.cluster_id)].append(package)  # Convert numpy.int32 to Python int
+def format_results(json_data: List[Dict[str, Any]], cluster_labels: np.ndarray) -> List[Dict[str, Any]]:
+    return [
+        {
+            'package': item['package'],
+            'errors': item['errors'],
+            'cluster_id': cluster_id
+        }
+        for item, cluster_id in zip(json_data, cluster_labels.tolist())
+    ]
+
+def summarize_clusters(json_data: List[Dict[str, Any]], cluster_labels: np.ndarray) -> Dict[str, Any]:
+    # Return errors instead of package names
+    clusters = group_by_cluster([item['errors'] for item in json_data], cluster_labels)
     
     summary = {
         'total_clusters': len(clusters),
         'clusters': {}
     }
     
-    for cluster_id, packages in clusters.items():
+    for cluster_id, errors in clusters.items():
         summary['clusters'][str(cluster_id)] = {
-            'size': len(packages),
-            'packages': [p.errors for p in packages]  # Return errors instead of package names
+            'size': len(errors),
+            'packages': errors
         }
     
-    return summary 
\ No newline at end of file
+    return summary
+
+def get_clustering_results(json_data: List[Dict[str, Any]], n_clusters: int = 10) -> List[Dict[str, Any]]:
+    return format_results(json_data, cluster_payload(json_data, n_clusters))
+
+def get_cluster_summary(json_data: List[Dict[str, Any]], n_clusters: int = 10) -> Dict[str, Any]:
+    return summarize_clusters(json_data, cluster_payload(json_data, n_clusters))
+
+def get_cluster_report(json_data: List[Dict[str, Any]], n_clusters: int = 10) -> Dict[str, Any]:
+    """Return the per-package results and the cluster summary from a single clustering."""
+    cluster_labels = cluster_payload(json_data, n_clusters)
+    return {
+        'results': format_results(json_data, cluster_labels),
+        'summary': summarize_clusters(json_data, cluster_labels)
+    }
@@ -1,31 +1,58 @@
-from typing import List, Dict, Any
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.cluster import KMeans
+from typing import List, Dict, Any, Optional, Tuple
+from sklearn.feature_extraction.text import HashingVectorizer, TfidfTransformer
+from sklearn.cluster import MiniBatchKMeans
+from sklearn.preprocessing import normalize
 import numpy as np
-from dataclasses import dataclass
 from collections import defaultdict
 import math
+import threading
+from cachetools import TTLCache
+from joblib import Parallel, delayed
+from text_features import hash_texts, get_n_jobs, payload_key, group_by_cluster, CentroidsCache
+
+# Payloads with fewer packages cluster their language groups in-process
+PARALLEL_MIN_PACKAGES = 2000
+# Language groups up to this size are clustered by error type instead of K-means
+ERROR_TYPE_MAX_SAMPLES = 16
+# Number of centroid sets kept for warm-starting K-means
+CENTROIDS_CACHE_SIZE = 256
+# Iteration limit of K-means runs that start from cached centroids
+WARM_START_MAX_ITER = 20
+
+# Cluster labels of recently clustered payloads, keyed by payload hash
+_labels_cache = TTLCache(maxsize=64, ttl=60)
+_labels_cache_lock = threading.Lock()
+
+# LRU of converged K-means centroids keyed by (language, n_clusters)
+_centroids_cache = CentroidsCache(CENTROIDS_CACHE_SIZE)
+
+# Stateless term hasher shared by all language groups
+HASHER = HashingVectorizer(
+    n_features=2 ** 14,
+    alternate_sign=False,
+    norm=None,
+    ngram_range=(1, 2),
+    stop_words='english',
+    dtype=np.float32
+)
 
-@dataclass
 class Package:
-    name: str
-    error_type: str
-    programming_language: str
-    description: str
-    cluster_id: int = -1
+    __slots__ = ('name', 'error_type', 'programming_language', 'description', 'cluster_id')
+
+    def __init__(self, name: str, error_type: str, programming_language: str,
+                 description: str, cluster_id: int = -1):
+        self.name = name
+        self.error_type = error_type
+        self.programming_language = programming_language
+        self.description = description
+        self.cluster_id = cluster_id
 
 def load_packages(json_data: List[Dict[str, Any]]) -> List[Package]:
-    packages = []
-    for item in json_data:
-        if not item.get('programming_language'):
-            continue
-        packages.append(Package(
-            name=item['package'],
-            error_type=item['error_type'],
-            programming_language=item['programming_language'],
-            description=item['description']
-        ))
-    return packages
+    return [
+        Package(item['package'], item['error_type'], item['programming_language'], item['description'])
+        for item in json_data
+        if item.get('programming_language')
+    ]
 
 def get_optimal_clusters(n_samples: int, min_clusters: int = 1, max_clusters: int = 20) -> int:
     """Calculate optimal number of clusters using logarithmic scale."""
@@ -36,81 +63,132 @@ def get_optimal_clusters(n_samples: int, min_clusters: int = 1, max_clusters: in
     n_clusters = int(math.log2(n_samples)) + 1
     return min(max(n_clusters, min_clusters), min(max_clusters, n_samples))
 
-def cluster_packages(packages: List[Package]) -> List[Package]:
-    # Group packages by programming language
-    language_groups = defaultdict(list)
-    for package in packages:
-        language_groups[package.programming_language].append(package)
+def _cluster_one_language(counts, n_clusters: int, cluster_id_offset: int,
+                          init_centers: Optional[np.ndarray] = None) -> Tuple[List[int], np.ndarray]:
+    """
+    Cluster the term counts of one language group, optionally starting from the centroids
+    of a previous run, and return its cluster IDs and the converged centroids.
+    """
+    # Weight the language group's term counts with its own IDF
+    features = normalize(TfidfTransformer().fit_transform(counts), norm='l2', copy=False)
     
-    # Process each language group separately
-    cluster_id_counter = 0
-    for language, lang_packages in language_groups.items():
-        if not lang_packages:
-            continue
-            
-        # Calculate optimal number of clusters for this language group
-        n_clusters = get_optimal_clusters(len(lang_packages))
-        print(f"Language: {language}, Samples: {len(lang_packages)}, Clusters: {n_clusters}")
-            
-        # If we only have one sample, assign it to a single cluster
-        if len(lang_packages) == 1:
-            lang_packages[0].cluster_id = cluster_id_counter
-            cluster_id_counter += 1
-            continue
-            
-        # Create feature vectors from error types and descriptions
-        texts = [f"{p.error_type} {p.description}" for p in lang_packages]
-        
-        # Convert text to TF-IDF vectors
-        vectorizer = TfidfVectorizer(max_features=1000, stop_words='english')
-        features = vectorizer.fit_transform(texts)
-        
-        # Apply K-means clustering
-        kmeans = KMeans(n_clusters=n_clusters, random_state=42)
-        cluster_labels = kmeans.fit_predict(features.toarray())
+    # Apply mini-batch K-means clustering directly on the sparse vectors
+    batch_size = min(1024, counts.shape[0])
+    if init_centers is not None:
+        kmeans = MiniBatchKMeans(n_clusters=n_clusters, init=init_centers, n_init=1, batch_size=batch_size,
+                                 max_iter=WARM_START_MAX_ITER, random_state=42)
+    else:
+        kmeans = MiniBatchKMeans(n_clusters=n_clusters, batch_size=batch_size, n_init=3,
+                                 max_iter=50, random_state=42)
+    cluster_labels = kmeans.fit_predict(features)
+    
+    # Convert cluster IDs to Python ints in one conversion
+    return (cluster_labels + cluster_id_offset).tolist(), kmeans.cluster_centers_
+
+def _cluster_by_error_type(packages: List[Package], cluster_id_offset: int) -> List[int]:
+    """Give every distinct error type its own cluster."""
+    error_type_ids = {}
+    return [
+        error_type_ids.setdefault(package.error_type, len(error_type_ids)) + cluster_id_offset
+        for package in packages
+    ]
+
+def predict_clusters(packages: List[Package]) -> np.ndarray:
+    """Return the cluster ID of every package as one array."""
+    if not packages:
+        return np.empty(0, dtype=np.int64)
         
-        # Assign cluster IDs
-        for package, label in zip(lang_packages, cluster_labels):
-            package.cluster_id = cluster_id_counter + label
-            
-        cluster_id_counter += n_clusters
+    # Group package indices by programming language
+    language_groups = defaultdict(list)
+    for index, package in enumerate(packages):
+        language_groups[package.programming_language].append(index)
+    groups = list(language_groups.values())
+    
+    # Every language group gets its own range of cluster IDs: one per error type
+    # for small groups and the K-means cluster count for the others
+    n_clusters = [
+        get_optimal_clusters(len(indices)) if len(indices) > ERROR_TYPE_MAX_SAMPLES
+        else len({packages[i].error_type for i in indices})
+        for indices in groups
+    ]
+    offsets = np.cumsum([0] + n_clusters[:-1]).tolist()
+    cluster_labels = np.empty(len(packages), dtype=np.int64)
+    
+    # Small groups are clustered by exact error type, larger ones by K-means
+    kmeans_groups = []
+    for language, indices, k, offset in zip(language_groups, groups, n_clusters, offsets):
+        if len(indices) > ERROR_TYPE_MAX_SAMPLES:
+            kmeans_groups.append((language, indices, k, offset))
+        else:
+            cluster_labels[indices] = _cluster_by_error_type([packages[i] for i in indices], offset)
+    if not kmeans_groups:
+        return cluster_labels
+    
+    # Hash error types and descriptions of the K-means groups in one pass
+    rows = [i for _, indices, _, _ in kmeans_groups for i in indices]
+    counts = hash_texts(HASHER, [f"{packages[i].error_type} {packages[i].description}" for i in rows])
+    bounds = np.cumsum([0] + [len(indices) for _, indices, _, _ in kmeans_groups]).tolist()
+    
+    # Cluster the language groups independently, in parallel for large payloads,
+    # starting from the centroids each language converged to last time
+    n_jobs = get_n_jobs() if len(rows) >= PARALLEL_MIN_PACKAGES else 1
+    results = Parallel(n_jobs=n_jobs, backend='loky', batch_size='auto')(
+        delayed(_cluster_one_language)(
+            counts[start:end], k, offset, _centroids_cache.get((language, k), (k, counts.shape[1]))
+        )
+        for (language, _, k, offset), start, end in zip(kmeans_groups, bounds, bounds[1:])
+    )
+    
+    # Scatter the cluster IDs of every group back into package order
+    for (language, indices, k, _), (cluster_ids, centers) in zip(kmeans_groups, results):
+        cluster_labels[indices] = cluster_ids
+        _centroids_cache.store((language, k), centers)
     
-    return packages
+    return cluster_labels
 
-def get_clustering_results(json_data: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-    # Load and process packages
+def cluster_payload(json_data: List[Dict[str, Any]]) -> Tuple[List[Package], np.ndarray]:
+    """Load and cluster packages, reusing the labels of a payload clustered shortly before."""
     packages = load_packages(json_data)
-    clustered_packages = cluster_packages(packages)
+    key = payload_key(json_data)
+    with _labels_cache_lock:
+        cluster_labels = _labels_cache.get(key)
+    if cluster_labels is None:
+        cluster_labels = predict_clusters(packages)
+        with _labels_cache_lock:
+            _labels_cache[key] = cluster_labels
     
-    # Format results and convert numpy types to Python native types
-    results = []
-    for package in clustered_packages:
-        results.append({
+    # Assign cluster IDs as Python ints in one conversion
+    for package, cluster_id in zip(packages, cluster_labels.tolist()):
+        package.cluster_id = cluster_id
+    return packages, cluster_labels
+
+def format_results(packages: List[Package]) -> List[Dict[str, Any]]:
+    return [
+        {
             "package": package.name,
-            "cluster_id": int(package.cluster_id),  # Convert numpy.int64 to Python int
+            "cluster_id": package.cluster_id,
             "programming_language": package.programming_language
-        })
-    
-    return results
+        }
+        for package in packages
+    ]
 
-def get_cluster_summary(json_data: List[Dict[str, Any]]) -> Dict[str, Any]:
-    packages = load_packages(json_data)
-    clustered_packages = cluster_packages(packages)
-    
-    # Group packages by cluster
-    clusters = defaultdict(list)
-    for package in clustered_packages:
-        clusters[int(package.cluster_id)].append({  # Convert numpy.int64 to Python int
+def summarize_clusters(packages: List[Package], cluster_labels: np.ndarray) -> Dict[str, Any]:
+    # Describe every package and count packages and clusters per language in one pass
+    entries = []
+    language_counts = defaultdict(int)
+    language_clusters = defaultdict(set)
+    for package in packages:
+        entries.append({
             "package": package.name,
             "error_type": package.error_type,
             "programming_language": package.programming_language,
             "description": package.description
         })
-    
-    # Count packages per language
-    language_counts = defaultdict(int)
-    for package in packages:
         language_counts[package.programming_language] += 1
+        language_clusters[package.programming_language].add(package.cluster_id)
+    
+    # Group packages by cluster
+    clusters = group_by_cluster(entries, cluster_labels)
     
     return {
         "total_clusters": len(clusters),
@@ -118,8 +196,36 @@ def get_cluster_summary(json_data: List[Dict[str, Any]]) -> Dict[str, Any]:
         "language_stats": {
             lang: {
                 "count": count,
-                "clusters": get_optimal_clusters(count)
+                "clusters": len(language_clusters[lang])
             }
             for lang, count in language_counts.items()
         }
-    } 
\ No newline at end of file
+    }
+
+def get_clustering_results(json_data: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    packages, _ = cluster_payload(json_data)
+    return format_results(packages)
+
+def get_batch_clustering_results(json_batches: List[List[Dict[str, Any]]]) -> List[Any]:
+    """
+    Cluster several payloads in one call, each on its own so that its labels do not depend
+    on the other payloads. A payload that fails gets its exception instead of results.
+    """
+    results = []
+    for json_data in json_batches:
+        try:
+            results.append(get_clustering_results(json_data))
+        except Exception as e:
+            results.append(e)
+    return results
+
+def get_cluster_summary(json_data: List[Dict[str, Any]]) -> Dict[str, Any]:
+    return summarize_clusters(*cluster_payload(json_data))
+
+def get_cluster_report(json_data: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Return the per-package results and the cluster summary from a single clustering."""
+    packages, cluster_labels = cluster_payload(json_data)
+    return {
+        "results": format_results(packages),
+        "summary": summarize_clusters(packages, cluster_labels)
+    }
@@ -175,6 +175,61 @@ def test_kirill_api(data, n_clusters=10):
         print(f"Error: {response.status_code}")
         print(response.text)
 
+def check_report(report, result_key, summary_items):
+    # Every cluster of the summary must hold exactly the packages the results assign to it
+    clusters = {}
+    for result in report['results']:
+        clusters.setdefault(str(result['cluster_id']), []).append(result[result_key])
+    summary_clusters = report['summary']['clusters']
+    if sorted(clusters) != sorted(summary_clusters):
+        return False
+    return all(
+        summary_items(summary_clusters[cluster_id]) == items
+        for cluster_id, items in clusters.items()
+    )
+
+def test_petr_report(data):
+    print("\nTesting Petr's report endpoint:")
+    
+    response = requests.post("http://localhost:8000/petr/cluster/report", 
+                           json={"data": data})
+    if response.status_code == 200:
+        report = response.json()
+        print(f"Number of packages clustered: {len(report['results'])}")
+        print(f"Total number of clusters: {report['summary']['total_clusters']}")
+        matches = check_report(report, 'package', lambda cluster: [item['package'] for item in cluster])
+        print(f"Results match summary: {matches}")
+    else:
+        print(f"Error: {response.status_code}")
+        print(response.text)
+
+def test_kirill_report(data, n_clusters=10):
+    print("\nTesting Kirill's report endpoint:")
+    
+    response = requests.post("http://localhost:8000/kirill/cluster/report", 
+                           json={"data": data, "n_clusters": n_clusters})
+    if response.status_code == 200:
+        report = response.json()
+        print(f"Number of packages clustered: {len(report['results'])}")
+        print(f"Total number of clusters: {report['summary']['total_clusters']}")
+        matches = check_report(report, 'errors', lambda cluster: cluster['packages'])
+        print(f"Results match summary: {matches}")
+    else:
+        print(f"Error: {response.status_code}")
+        print(response.text)
+
+def test_admin_refit():
+    print("\nTesting vectorizer refit:")
+    
+    response = requests.post("http://localhost:8000/admin/refit")
+    if response.status_code == 200:
+        result = response.json()
+        print(f"Refitted: {result['refitted']}")
+        print(f"Number of features: {result['n_features']}")
+    else:
+        print(f"Error: {response.status_code}")
+        print(response.text)
+
 if __name__ == "__main__":
     # Load test data
     try:
@@ -182,6 +237,7 @@ if __name__ == "__main__":
             petr_data = json.load(f)
         print("\n=== Testing with Petr's data format ===")
         test_petr_api(petr_data)
+        test_petr_report(petr_data)
     except FileNotFoundError:
         print("petr.json not found")
     except json.JSONDecodeError:
@@ -192,6 +248,8 @@ if __name__ == "__main__":
             kirill_data = json.load(f)
         print("\n=== Testing with Kirill's data format ===")
         test_kirill_api(kirill_data)
+        test_kirill_report(kirill_data)
+        test_admin_refit()
     except FileNotFoundError:
         print("kirill.json not found")
     except json.JSONDecodeError:
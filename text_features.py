@@ -0,0 +1,73 @@
+from typing import List, Dict, Any, Optional, Tuple
+from sklearn.feature_extraction.text import HashingVectorizer
+from joblib import Parallel, delayed
+from collections import OrderedDict
+import numpy as np
+import scipy.sparse as sp
+import hashlib
+import threading
+import orjson
+
+# Number of texts hashed per job; smaller inputs are hashed in-process
+HASHING_CHUNK_SIZE = 5000
+
+# Number of processes parallel work may use; -1 uses every CPU
+_n_jobs = -1
+
+def set_n_jobs(n_jobs: int) -> None:
+    """Limit the processes used for parallel work, e.g. to the CPU share of a pool worker."""
+    global _n_jobs
+    _n_jobs = n_jobs
+
+def get_n_jobs() -> int:
+    return _n_jobs
+
+def hash_texts(hasher: HashingVectorizer, texts: List[str]) -> sp.csr_matrix:
+    """Hash texts into a sparse term count matrix, splitting large inputs across processes."""
+    if len(texts) <= HASHING_CHUNK_SIZE or _n_jobs == 1:
+        return hasher.transform(texts)
+    chunks = [texts[i:i + HASHING_CHUNK_SIZE] for i in range(0, len(texts), HASHING_CHUNK_SIZE)]
+    counts = Parallel(n_jobs=_n_jobs, backend='loky')(delayed(hasher.transform)(chunk) for chunk in chunks)
+    return sp.vstack(counts, format='csr')
+
+def payload_key(json_data: List[Dict[str, Any]]) -> str:
+    return hashlib.blake2b(orjson.dumps(json_data)).hexdigest()
+
+def group_by_cluster(items: List[Any], cluster_labels: np.ndarray) -> Dict[int, List[Any]]:
+    """Group items by cluster ID with one stable sort instead of per-item dict appends."""
+    order = np.argsort(cluster_labels, kind='stable')
+    cluster_ids, starts = np.unique(cluster_labels[order], return_index=True)
+    bounds = starts.tolist() + [len(order)]
+    order = order.tolist()
+    return {
+        cluster_id: [items[i] for i in order[start:end]]
+        for cluster_id, start, end in zip(cluster_ids.tolist(), bounds, bounds[1:])
+    }
+
+class CentroidsCache:
+    """Thread-safe LRU of converged K-means centroids used to warm-start later runs."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._centers: "OrderedDict[tuple, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple, shape: Tuple[int, int]) -> Optional[np.ndarray]:
+        """Return cached centroids for the key if they match the expected shape."""
+        with self._lock:
+            centers = self._centers.get(key)
+            if centers is None or centers.shape != shape:
+                return None
+            self._centers.move_to_end(key)
+            return centers
+
+    def store(self, key: tuple, centers: np.ndarray) -> None:
+        with self._lock:
+            self._centers[key] = centers
+            self._centers.move_to_end(key)
+            if len(self._centers) > self.maxsize:
+                self._centers.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._centers.clear()